@@ -3,14 +3,74 @@
 ##### Uniqname: sfringer
 #################################
 
-from bs4 import BeautifulSoup
+from lxml import etree # requires lxml>=5; it repairs malformed HTML a little differently than BeautifulSoup's 'html.parser'
+import lxml.html
 import requests
+from requests.adapters import HTTPAdapter
+import aiohttp
+import asyncio
+import threading
 import re
 import json
 import secrets # file that contains your API key
 
-CACHE_FILENAME = "project2_cache.json"
+try:
+    import orjson
+
+    def json_loads(data):
+        return orjson.loads(data)
+
+    def json_dumps(obj):
+        # nearby-place dicts are keyed by int, which orjson rejects by default
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+except ImportError: # fall back to the stdlib json module
+    def json_loads(data):
+        return json.loads(data)
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+
+CACHE_FILENAME = "project2_cache.jsonl"
 CACHE_DICT = {}
+## bump whenever the shape of cached values changes so stale caches get rebuilt
+CACHE_VERSION_KEY = "_cache_version"
+_CACHE_VERSION = 3
+
+## one pooled session for the single-page requests, so repeat calls to the same host reuse the connection
+_SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(pool_connections=10, pool_maxsize=20)
+_SESSION.mount("https://", _ADAPTER)
+_SESSION.mount("http://", _ADAPTER)
+
+## the state links in the "Find a Park" menu of the nps.gov home page
+_STATE_LINKS_XPATH = etree.XPath("//*[@id='HERO']//li/a")
+
+## the park detail links in the listing column of a state page (first link under each park heading)
+_PARK_LINKS_XPATH = etree.XPath(
+    "//div[contains(concat(' ', normalize-space(@class), ' '), ' col-md-9 ')"
+    " and contains(concat(' ', normalize-space(@class), ' '), ' stateCol ')]"
+    "/div[2]//h3/descendant::a[1]/@href"
+)
+
+## every field of a site page in one compiled query; class tests match whole class tokens
+_SITE_FIELDS_XPATH = etree.XPath(
+    "//span[contains(concat(' ', normalize-space(@class), ' '), ' Hero-designation ')]"
+    " | //a[contains(concat(' ', normalize-space(@class), ' '), ' Hero-title ')]"
+    " | //span[contains(concat(' ', normalize-space(@class), ' '), ' tel ')]"
+    " | //span[@itemprop='postalCode' or @itemprop='addressRegion' or @itemprop='addressLocality']"
+)
+_SITE_FIELD_KEYS = {
+    'Hero-designation': 'type',
+    'Hero-title': 'name',
+    'tel': 'number',
+    'postalCode': 'zip',
+    'addressRegion': 'state',
+    'addressLocality': 'city',
+}
+
+## runs of whitespace (including newlines inside a field) collapse to one space
+_WS = re.compile(r"\s+")
 
 class NationalSite:
     '''a national site
@@ -33,6 +93,8 @@ class NationalSite:
     phone: string
         the phone of a national site (e.g. '(616) 319-7906', '307-344-7381')
     '''
+    __slots__ = ("category", "name", "address", "zipcode", "phone")
+
     def __init__(self, category="No Category", name="No Name", address="No Address", zipcode="No Zipcode", phone="No Phone Number"):
         self.category = category
         self.name = name
@@ -53,7 +115,7 @@ class NationalSite:
         The information of the object in the format: name (category): address zip  
         '''
 
-        return self.name + " " + "(" + self.category + "): " + self.address + " " + self.zipcode
+        return f"{self.name} ({self.category}): {self.address} {self.zipcode}"
 
 
 def build_state_url_dict():
@@ -69,34 +131,97 @@ def build_state_url_dict():
         key is a state name and value is the url
         e.g. {'michigan':'https://www.nps.gov/state/mi/index.htm', ...}
     '''
-    dict = {}
     url = "https://www.nps.gov/index.htm"
     
-    if url in CACHE_DICT.keys():
+    if url in CACHE_DICT:
         print("Using Cache")
         return CACHE_DICT[url]
     
     else:
         print("Fetching")
-        response = requests.get(url)
-        soup = BeautifulSoup(response.text, 'html.parser')
-        state_elements = soup.find_all(id='HERO')
-        state_items = state_elements[0].find_all('li')
+        response = _SESSION.get(url, timeout=10)
+        tree = lxml.html.fromstring(response.text)
+        state_anchors = _STATE_LINKS_XPATH(tree)
+        state_urls = dict((a.text_content().strip().lower(), f"https://www.nps.gov{a.get('href')}") for a in state_anchors)
+        CACHE_DICT[url] = state_urls
+        append_cache(url, CACHE_DICT[url])
+        return CACHE_DICT[url]
 
-        for item in state_items:
-            html_tag = item.find('a')
-            state = item.text.strip()
 
-            state_link = html_tag['href']
-            dict[state] = "https://www.nps.gov" + state_link
-        
-        dict =  {i.lower(): j for i, j in dict.items()}
-        response = requests.get(url)
-        CACHE_DICT[url] = dict
-        save_cache(CACHE_DICT)
-        return CACHE_DICT[url]
+async def fetch_page_texts(urls, limit=10):
+    '''Download several pages concurrently without touching the cache,
+    with at most limit requests in flight at once.
+    
+    Parameters
+    ----------
+    urls: list
+        The URLs of the pages to fetch
+
+    limit: int
+        The maximum number of concurrent requests
     
-    return dict
+    Returns
+    -------
+    list
+        the body of each response, in the same order as urls;
+        None for a response without a 200 status or a request that failed,
+        so it is never cached
+    '''
+    semaphore = asyncio.Semaphore(limit)
+
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
+        async def fetch(url):
+            async with semaphore:
+                try:
+                    async with session.get(url) as response:
+                        if response.status != 200:
+                            return None
+                        return await response.text()
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    return None
+
+        return await asyncio.gather(*(fetch(url) for url in urls))
+
+
+def _clean(text):
+    '''Collapse internal whitespace and trim the ends of scraped text.'''
+    return _WS.sub(" ", text).strip() if text else text
+
+
+def parse_site_page(page_text):
+    '''Pull the national site fields out of a site page.
+    
+    Parameters
+    ----------
+    page_text: string
+        The HTML of a national site page in nps.gov
+    
+    Returns
+    -------
+    dict
+        the keyword arguments for NationalSite
+        e.g. {'category': 'National Park', 'name': 'Yellowstone', ...}
+    '''
+    tree = lxml.html.fromstring(page_text)
+    fields = {'type': "No Type", 'name': "No Name", 'number': "No Number", 'zip': "No Zip", 'state': "No State", 'city': "No City"}
+    found = set()
+    for element in _SITE_FIELDS_XPATH(tree):
+        markers = [element.get('itemprop')] + element.get('class', '').split()
+        key = next((_SITE_FIELD_KEYS[m] for m in markers if m in _SITE_FIELD_KEYS), None)
+        if key is None:
+            continue
+        ## keep the first match for each field
+        if key not in found:
+            found.add(key)
+            fields[key] = _clean(element.text_content())
+
+    return {
+        'category': fields['type'],
+        'name': fields['name'],
+        'address': f"{fields['city']}, {fields['state']}",
+        'zipcode': fields['zip'],
+        'phone': fields['number'],
+    }
 
 
 def get_site_instance(site_url):
@@ -113,28 +238,20 @@ def get_site_instance(site_url):
         a national site instance
     '''
     
-    if site_url in CACHE_DICT.keys():
+    if site_url in CACHE_DICT:
         print("Using Cache")
+        site_fields = CACHE_DICT[site_url]
 
     else:
         print("Fetching")
-        response = requests.get(site_url)
-        CACHE_DICT[site_url] = response.text
-        save_cache(CACHE_DICT)
-    
-    soup = BeautifulSoup(CACHE_DICT[site_url], 'html.parser')
-    park_type = (soup.find('span',{'class':'Hero-designation'}).text) if (soup.find('span',{'class':'Hero-designation'})) else "No Type"
-    park_name = (soup.find('a',{'class':'Hero-title'}).text) if (soup.find('a',{'class':'Hero-title'})) else "No Name"
-    park_number = (soup.find('span',{'class':'tel'}).text) if (soup.find('span',{'class':'tel'})) else "No Number"
-    park_number = park_number.strip()
-    park_zip = (soup.find('span',{'itemprop':'postalCode'}).text) if (soup.find('span',{'itemprop':'postalCode'})) else "No Zip"
-    park_zip = park_zip.strip()
-    park_state = (soup.find('span',{'itemprop':'addressRegion'}).text) if (soup.find('span',{'itemprop':'addressRegion'})) else "No State"
-    park_city = (soup.find('span',{'itemprop':'addressLocality'}).text) if (soup.find('span',{'itemprop':'addressLocality'})) else "No City"
-    park_address = park_city + ", " + park_state
-    instance = NationalSite(park_type, park_name, park_address, park_zip, park_number)
-
-        
+        response = _SESSION.get(site_url, timeout=10)
+        site_fields = parse_site_page(response.text)
+        ## an error page is not cached, so the site is fetched again next time
+        if response.status_code == 200:
+            CACHE_DICT[site_url] = site_fields
+            append_cache(site_url, CACHE_DICT[site_url])
+    
+    instance = NationalSite(**site_fields)
     return instance
 
 
@@ -153,37 +270,89 @@ def get_sites_for_state(state_url):
         a list of national site instances
     '''
     
-    if state_url in CACHE_DICT.keys():
+    if state_url in CACHE_DICT:
         print("Using Cache")
 
     else:
         print("Fetching")
-        response = requests.get(state_url)
+        response = _SESSION.get(state_url, timeout=10)
         CACHE_DICT[state_url] = response.text
-        save_cache(CACHE_DICT)
+        append_cache(state_url, CACHE_DICT[state_url])
         
-    soup = BeautifulSoup(CACHE_DICT[state_url], 'html.parser')
+    tree = lxml.html.fromstring(CACHE_DICT[state_url])
     BASE_URL = "https://www.nps.gov"
     park_list = []
 
-    ## For each park listed
-    park_listing_parent = soup.find('div', class_='col-md-9 col-sm-12 col-xs-12 stateCol')
-    park_listing_divs = park_listing_parent.find_all('div', recursive=False)
-    park_url_items = park_listing_divs[1].find_all('h3')
-
-    for item in park_url_items:   
-        ## extract the park details URL
-        park_link_tag = item.find('a')
-        park_details_path = park_link_tag['href']
-        park_details_url = BASE_URL + park_details_path
-
-        park_instance = get_site_instance(park_details_url)
+    ## extract the park details URL for each park listed
+    park_urls = [f"{BASE_URL}{park_details_path}" for park_details_path in _PARK_LINKS_XPATH(tree)]
+
+    ## fetch the uncached park pages concurrently, then cache them here once they are all back
+    missing_urls = [url for url in park_urls if url not in CACHE_DICT]
+    fetched_sites = {}
+    if missing_urls:
+        page_texts = asyncio.run(fetch_page_texts(missing_urls))
+        for url, text in zip(missing_urls, page_texts):
+            ## a failed page is left uncached for get_site_instance to fetch again
+            if text is None:
+                continue
+            print("Fetching")
+            CACHE_DICT[url] = parse_site_page(text)
+            append_cache(url, CACHE_DICT[url])
+            fetched_sites[url] = NationalSite(**CACHE_DICT[url])
+
+    for park_details_url in park_urls:
+        if park_details_url in fetched_sites:
+            park_instance = fetched_sites[park_details_url]
+        else:
+            park_instance = get_site_instance(park_details_url)
         park_list.append(park_instance)
 
     return park_list
     
 
 
+def nearby_places_url(zipcode):
+    '''Build the MapQuest radius search URL for a zipcode.
+    
+    Parameters
+    ----------
+    zipcode: string
+        the zipcode of a national site
+    
+    Returns
+    -------
+    string
+        the MapQuest API request URL
+    '''
+    return f"http://www.mapquestapi.com/search/v2/radius?key={secrets.API_KEY}&origin={zipcode}&radius=10&maxMatches=10&ambiguities=ignore&outFormat=json"
+
+
+def parse_nearby_places(json_dict):
+    '''Format the places in a MapQuest radius search response.
+    
+    Parameters
+    ----------
+    json_dict: dict
+        the decoded MapQuest API response
+    
+    Returns
+    -------
+    dict
+        numbered places, e.g. {1: 'name (category): street, city', ...}
+        empty if the response has no search results
+    '''
+    field_list = []
+
+    for result in json_dict.get('searchResults', []):
+        fields = result['fields']
+        place_street = fields['address'] or "No Address"
+        place_city = fields['city'] or "No City"
+        field_list.append(f"{fields['name']} ({fields['group_sic_code_name']}): {place_street}, {place_city}")
+
+    ## keep the numbered dict callers (and existing caches) expect
+    return dict(enumerate(field_list, 1))
+
+
 def get_nearby_places(site_object):
     '''Obtain API data from MapQuest API.
     
@@ -200,7 +369,7 @@ def get_nearby_places(site_object):
     field_dict = {}
     zipcode = site_object.zipcode
 
-    if zipcode in CACHE_DICT.keys():
+    if zipcode in CACHE_DICT:
         print("Using Cache")
         if zipcode == "No Zip":
             print("This site did not contain a zip code. Therefore we could not find any nearby places. Please try again!")
@@ -215,50 +384,63 @@ def get_nearby_places(site_object):
             field_dict = {}
 
         else:
-            response = requests.get("http://www.mapquestapi.com/search/v2/radius?key=" + str(secrets.API_KEY) + "&origin=" + str(zipcode) + "&radius=10&maxMatches=10&ambiguities=ignore&outFormat=json")
+            response = _SESSION.get(nearby_places_url(zipcode), timeout=10)
             
-            json_str = response.text
-            json_dict = json.loads(json_str)
+            json_dict = json_loads(response.content)
             if 'searchResults' not in json_dict:
                 print("There are no nearby places within the radius of the site. Please try again")
-                field_dict = {}
-            
-            else:
-                sR_dict = json_dict['searchResults']
-                fields_info = []
-                counter = 1
-
-                for j in sR_dict:
-                    fields_info.append(j['fields'])
-
-                for i in fields_info:
-                    place_name = i['name']
-                    place_category = i['group_sic_code_name']
-
-                    if i['address'] == "":
-                        place_street = "No Address"
-                    else: 
-                        place_street = i['address']
-                    
-                    if i['city'] == "":
-                        place_city = "No City"
-                    else: 
-                        place_city = i['city']
-                    
-                    field_dict[counter] = (place_name + " " + "(" + place_category + "): " + place_street + ", " + place_city)
-                    counter += 1
+            field_dict = parse_nearby_places(json_dict)
 
         CACHE_DICT[zipcode] = field_dict
-        save_cache(CACHE_DICT)
+        append_cache(zipcode, CACHE_DICT[zipcode])
         return CACHE_DICT[zipcode]
-            
-    return field_dict
+
+
+async def prefetch_nearby(park_list):
+    '''Fetch and cache the nearby places of every park in a list at once,
+    so choosing a park afterwards is a cache hit. Requests are capped at 5
+    in flight to stay within MapQuest's rate limits. Parks without a zip
+    code or already in the cache are skipped, and a failed fetch just
+    leaves the park to be fetched on demand by get_nearby_places.
+    
+    Parameters
+    ----------
+    park_list: list
+        national site instances
+    
+    Returns
+    -------
+    None
+    '''
+    zipcodes = []
+    for park in park_list:
+        if park.zipcode != "No Zip" and park.zipcode not in CACHE_DICT and park.zipcode not in zipcodes:
+            zipcodes.append(park.zipcode)
+
+    if not zipcodes:
+        return
+
+    responses = await fetch_page_texts([nearby_places_url(zipcode) for zipcode in zipcodes], limit=5)
+
+    for zipcode, response_text in zip(zipcodes, responses):
+        if response_text is None:
+            continue
+        ## a body that is not JSON (an error page, a bad-key message) or not shaped like a
+        ## radius search response is left for get_nearby_places
+        try:
+            field_dict = parse_nearby_places(json_loads(response_text))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            continue
+        CACHE_DICT[zipcode] = field_dict
+        append_cache(zipcode, CACHE_DICT[zipcode])
 
  
 def open_cache():
-    ''' Opens the cache file if it exists and loads the JSON into
-    the CACHE_DICT dictionary.
-    if the cache file doesn't exist, creates a new cache dictionary
+    ''' Opens the cache file if it exists and loads its JSON lines into
+    the CACHE_DICT dictionary. Each line holds one {"k": key, "v": value}
+    entry; a key written more than once keeps its last value.
+    if the cache file doesn't exist, or was written by an older version
+    of this program, creates a new cache dictionary
     
     Parameters
     ----------
@@ -268,18 +450,32 @@ def open_cache():
     -------
     The opened cache: dict
     '''
+    torn = False
     try:
-        cache_file = open(CACHE_FILENAME, 'r')
-        cache_contents = cache_file.read()
-        cache_dict = json.loads(cache_contents)
-        cache_file.close()
+        cache_dict = {}
+        with open(CACHE_FILENAME, 'rb') as cache_file:
+            ## decode one line at a time so only a single entry is held as bytes;
+            ## a line cut short by an interrupted append is skipped rather than losing the whole cache
+            for line in cache_file:
+                try:
+                    entry = json_loads(line)
+                    cache_dict[entry['k']] = entry['v']
+                except (ValueError, KeyError, TypeError):
+                    torn = True
     except:
         cache_dict = {}
+
+    if cache_dict.get(CACHE_VERSION_KEY) != _CACHE_VERSION:
+        cache_dict = {CACHE_VERSION_KEY: _CACHE_VERSION}
+        save_cache(cache_dict)
+    elif torn:
+        ## rewrite the file so the next append starts on a clean line
+        save_cache(cache_dict)
     return cache_dict
 
 
 def save_cache(cache_dict):
-    ''' Saves the current state of the cache to disk
+    ''' Rewrites the whole cache to disk, one JSON line per entry
     
     Parameters
     ----------
@@ -290,16 +486,36 @@ def save_cache(cache_dict):
     -------
     None
     '''
-    dumped_json_cache = json.dumps(cache_dict)
-    fw = open(CACHE_FILENAME,"w")
-    fw.write(dumped_json_cache)
-    fw.close() 
+    with open(CACHE_FILENAME, "wb") as fw:
+        for key, value in cache_dict.items():
+            fw.write(json_dumps({'k': key, 'v': value}) + b"\n")
+
+
+def append_cache(key, value):
+    ''' Appends a single new cache entry to disk, so a cache miss costs
+    one line written instead of re-dumping the whole cache
+    
+    Parameters
+    ----------
+    key: string
+        The cache key (a url or a zipcode)
+    
+    value: object
+        The value stored under key in CACHE_DICT
+    
+    Returns
+    -------
+    None
+    '''
+    with open(CACHE_FILENAME, "ab") as fw:
+        fw.write(json_dumps({'k': key, 'v': value}) + b"\n")
 
 
 if __name__ == "__main__":
     CACHE_DICT = open_cache()
-    dict = build_state_url_dict()
+    state_urls = build_state_url_dict()
     num_input = ""
+    prefetch_thread = None
 
     while True:
         if num_input == "exit":
@@ -315,18 +531,26 @@ if __name__ == "__main__":
             break
         
         try:
-            if user_input != "exit" and user_input in dict.keys():
+            if user_input != "exit" and user_input in state_urls:
+                ## let the previous state's prefetch finish before touching the cache again
+                if prefetch_thread is not None:
+                    prefetch_thread.join()
+
                 print('-' * 40)
                 print("List of national sites in", user_input)
                 print('-' * 40)
                 counter = 1
-                park_list = get_sites_for_state(dict[user_input])
+                park_list = get_sites_for_state(state_urls[user_input])
             
                 for i in park_list:
                     print("[",counter,"]", i.info())
                     counter += 1
                 print("\n")
 
+                ## look up nearby places in the background while the user reads the list
+                prefetch_thread = threading.Thread(target=asyncio.run, args=(prefetch_nearby(park_list),), daemon=True)
+                prefetch_thread.start()
+
                 while True:
                     num_input = input("Choose the number for detail search or \'exit' or back: ")
                     print("\n")
@@ -335,6 +559,7 @@ if __name__ == "__main__":
                         num_input = int(num_input)
 
                         if num_input < counter:
+                            prefetch_thread.join()
                             nearby_place_instance = park_list[num_input-1]
                             field_dict = get_nearby_places(nearby_place_instance)
                             
@@ -366,13 +591,17 @@ if __name__ == "__main__":
                         else:
                             print("[Error] Invalid Input")
             
-            elif user_input != "exit" and user_input not in dict.keys():
+            elif user_input != "exit" and user_input not in state_urls:
                 print("[Error] Enter proper state name")
                 print("\n")
             
         except ValueError:
             print("Invalid Input!")
             break
+
+    ## let a running prefetch finish its cache writes rather than dying mid-line at shutdown
+    if prefetch_thread is not None:
+        prefetch_thread.join()
             
       
 